@@ -17,15 +17,88 @@
 # Description: Implementation of PF algorithm
 # ==============================================
 
+import functools
+from collections import OrderedDict
 from typing import List
 import torch
 import numpy as np
-from scipy.stats import gamma
+from numba import int64, njit, prange, uint64
+from scipy.stats import gamma, norm
 from sympy.physics.units import temperature
 
 from ..base import BaseConfig, BaseWatermark
 from utils.transformers_config import TransformersConfig
 
+
+@njit(uint64(uint64, uint64), cache=True)
+def _addmod(a: np.uint64, b: np.uint64) -> np.uint64:
+    """Compute (a + b) % (2 ** 64 - 1) in wrapping uint64 arithmetic."""
+    s = a + b
+    # a wrap past 2 ** 64 contributes +1, since 2 ** 64 = 1 mod (2 ** 64 - 1)
+    if s < a:
+        s += np.uint64(1)
+    if s == np.uint64(2 ** 64 - 1):
+        s = np.uint64(0)
+    return s
+
+
+@njit(uint64(uint64, uint64), cache=True)
+def _mulmod(a: np.uint64, b: np.uint64) -> np.uint64:
+    """Compute (a * b) % (2 ** 64 - 1) via a 128-bit product split in 32-bit halves."""
+    mask = np.uint64(0xFFFFFFFF)
+    a_hi, a_lo = a >> np.uint64(32), a & mask
+    b_hi, b_lo = b >> np.uint64(32), b & mask
+    hi = a_hi * b_hi
+    mid1 = a_hi * b_lo
+    mid2 = a_lo * b_hi
+    lo = a_lo * b_lo
+    t = lo + ((mid1 & mask) << np.uint64(32))
+    if t < lo:
+        hi += np.uint64(1)
+    hi += mid1 >> np.uint64(32)
+    lo = t
+    t = lo + ((mid2 & mask) << np.uint64(32))
+    if t < lo:
+        hi += np.uint64(1)
+    hi += mid2 >> np.uint64(32)
+    # a * b = hi * 2 ** 64 + t = hi + t mod (2 ** 64 - 1)
+    return _addmod(hi, t)
+
+
+@njit(uint64(uint64[:], uint64, uint64), cache=True)
+def _hash_seed(input_ids: np.ndarray, seed: np.uint64, salt_key: np.uint64) -> np.uint64:
+    """Compiled equivalent of the interpreted 'hash' seeding loop."""
+    for i in input_ids:
+        seed = _addmod(_mulmod(seed, salt_key), i)
+    return seed
+
+
+@njit(uint64[:](uint64[:], int64, uint64, uint64), cache=True, parallel=True)
+def _hash_seeds_all(tokens: np.ndarray, ngram: int, seed: np.uint64, salt_key: np.uint64) -> np.ndarray:
+    """Hash the ngram window at every scorable position, parallel across positions."""
+    n = tokens.shape[0] - (ngram + 1)
+    if n < 0:
+        n = 0
+    out = np.empty(n, dtype=np.uint64)
+    for i in prange(n):
+        s = seed
+        for j in range(i + 1, i + 1 + ngram):
+            s = _addmod(_mulmod(s, salt_key), tokens[j])
+        out[i] = s
+    return out
+
+
+@functools.lru_cache(maxsize=4096)
+def _gamma_ppf(alpha: float, k: int) -> float:
+    """Cached upper-tail gamma quantile used as the detection threshold."""
+    if k > 1000:
+        # Wilson-Hilferty approximation; skips scipy's iterative root-find and
+        # its relative error is negligible at this shape
+        z = norm.ppf(1 - alpha)
+        return k * (1 - 1 / (9 * k) + z * (1 / (9 * k)) ** 0.5) ** 3
+    return gamma.ppf(1 - alpha, a=k, scale=1)
+
+
 # PF algorithm configuration class
 class PFConfig(BaseConfig):
     """Config class for PF algorithm, load config file and initialize parameters."""
@@ -57,27 +130,33 @@ class PFUtils:
         self.config = config
         self.pad_id = config.generation_tokenizer.pad_token_id if config.generation_tokenizer.pad_token_id is not None else config.generation_tokenizer.eos_token_id
         self.eos_id = config.generation_tokenizer.eos_token_id
-        self.hashtable = torch.randperm(1000003)
+        # CPU Fisher-Yates permutation instead of torch's sort-based randperm;
+        # int32 halves the table's footprint once moved to the device
+        hashtable = np.random.default_rng(self.config.seed).permutation(1000003).astype(np.int32)
+        self.hashtable = torch.from_numpy(hashtable).to(self.config.device)
         self.rng = torch.Generator(device=self.config.device)
         self.rng.manual_seed(self.config.seed)
+        # detection LRU cache of seed -> uniform row; repeated ngrams (common for
+        # stopword windows) then skip the vocab-sized RNG draw. Each entry holds
+        # vocab_size floats, so the capacity bounds it to a few hundred MB at most
+        self._rs_cache = OrderedDict()
+        self._rs_cache_capacity = 1024
 
     def hashint(self, integer_tensor: torch.LongTensor) -> torch.LongTensor:
         """Adapted from https://github.com/jwkirchenbauer/lm-watermarking"""
-        return self.hashtable[integer_tensor.cpu() % len(self.hashtable)]
+        return self.hashtable[integer_tensor % len(self.hashtable)]
 
 
     def get_seed_rng(self, input_ids: torch.LongTensor) -> int:
         """get a random seed according to input tokens."""
         if self.config.seeding == 'hash':
-            seed = self.config.seed
-            for i in input_ids:
-                seed = (seed * self.config.salt_key + i.item()) % (2 ** 64 - 1)
+            # one bulk transfer instead of a device sync per .item() call
+            ids = input_ids.cpu().numpy().astype(np.uint64)
+            seed = int(_hash_seed(ids, np.uint64(self.config.seed), np.uint64(self.config.salt_key)))
         elif self.config.seeding == 'additive':
-            seed = self.config.salt_key * torch.sum(input_ids).item()
-            seed = self.hashint(seed)
+            seed = self.hashint(self.config.salt_key * torch.sum(input_ids)).item()
         elif self.config.seeding == 'skip':
-            seed = self.config.salt_key * input_ids[0].item()
-            seed = self.hashint(seed)
+            seed = self.hashint(self.config.salt_key * input_ids[0]).item()
         elif self.config.seeding == 'min':
             seed = self.hashint(self.config.salt_key * input_ids)
             seed = torch.min(seed).item()
@@ -92,27 +171,51 @@ class PFUtils:
     ) -> torch.LongTensor:
         """generate next token from logits."""
         if temperature > 0:
-            probs = torch.softmax(logits / temperature, dim=-1)
-            probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-            probs_sum = torch.cumsum(probs_sort, dim=-1)
-            mask = probs_sum - probs_sort > top_p
-            probs_sort[mask] = 0.0
-            probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-            log_probs = probs_sort.log()
-
-            seed = self.get_seed_rng(ngram_tokens)
-            self.rng.manual_seed(seed)
-
-            rs = torch.rand(self.config.vocab_size, generator=self.rng, device=self.rng.device)
-            rs = rs.roll(-self.config.payload)
-            rs = torch.Tensor(rs).to(probs_sort.device)
-            rs = rs[probs_idx]
-
-            log_probs = log_probs - rs.log()
-
-
-            next_token = torch.argmax(log_probs, dim=-1, keepdim=True)
-            next_token = torch.gather(probs_idx, -1, next_token)
+            # the sampler is memory-bound on (bsz, vocab_size) tensors; halve
+            # their bandwidth on accelerators by working in bfloat16
+            if logits.is_cuda and logits.dtype == torch.float32:
+                logits = logits.to(torch.bfloat16)
+            bsz = logits.shape[0]
+            if ngram_tokens.dim() == 1:
+                ngram_tokens = ngram_tokens.unsqueeze(0).expand(bsz, -1)
+
+            # one (bsz, vocab_size) uniform matrix from the per-sequence seeds;
+            # move the ngrams to the host once rather than syncing per row
+            ngram_cpu = ngram_tokens.cpu()
+            rs = torch.empty((bsz, self.config.vocab_size), device=self.rng.device)
+            for ii in range(bsz):
+                self.rng.manual_seed(self.get_seed_rng(ngram_cpu[ii]))
+                torch.rand(self.config.vocab_size, generator=self.rng, out=rs[ii])
+
+            if top_p >= 1.0:
+                # without nucleus filtering, argmax(log p - log rs) is invariant to
+                # the softmax normalizer, so score logits / temperature directly
+                if self.config.payload:
+                    rs = rs.roll(-self.config.payload, dims=-1)
+                next_token = torch.argmax((logits / temperature).sub_(rs.log_()), dim=-1, keepdim=True)
+            else:
+                scaled = logits / temperature
+                # top-p only ever keeps a short sorted head, so a partial top-k
+                # selection replaces the O(V log V) full-vocab sort
+                top_k = min(self.config.vocab_size, 2048)
+                logits_sort, probs_idx = torch.topk(scaled, top_k, dim=-1)
+                # normalize with the full-vocab logsumexp so the nucleus
+                # boundary matches an exact softmax cumsum; promote the short
+                # head to fp32 so reduced precision cannot shift that boundary
+                probs_sort = torch.exp((logits_sort - torch.logsumexp(scaled, dim=-1, keepdim=True)).float())
+                probs_sum = torch.cumsum(probs_sort, dim=-1)
+                mask = probs_sum - probs_sort > top_p
+                # renormalizing only shifts the log-probs uniformly, which the
+                # argmax ignores, so mask in logit space and skip it
+                logits_sort[mask] = -float('inf')
+
+                # rs.roll(-payload)[probs_idx] equals columns (probs_idx + payload) % vocab_size;
+                # bias in place so no extra (bsz, top_k) score tensors are materialized
+                idx = (probs_idx + self.config.payload) % self.config.vocab_size
+                logits_sort.sub_(rs.gather(-1, idx).log_())
+
+                next_token = torch.argmax(logits_sort, dim=-1, keepdim=True)
+                next_token = torch.gather(probs_idx, -1, next_token)
         else:
             next_token = torch.argmax(logits, dim=-1)
 
@@ -136,8 +239,7 @@ class PFUtils:
             return float('inf')
 
         k = n_tokens - self.config.ngram
-        threshold = gamma.ppf(1 - alpha, a=k, scale=1)
-        return threshold
+        return _gamma_ppf(alpha, k)
 
     def get_scores_by_t(
             self,
@@ -159,40 +261,90 @@ class PFUtils:
         Output:
             score_lists: list of [np array of score increments for every token and payload] for each text
         """
-        tokens_id = self.config.generation_tokenizer.encode(text, add_special_tokens=False)
+        tokens_id = self.config.generation_tokenizer(text, add_special_tokens=False)['input_ids']
         if ntoks_max is not None:
             tokens_id = tokens_id[:ntoks_max]
 
         total_len = len(tokens_id)
         start_pos = self.config.ngram + 1
-        rts = []
         seen_ntuples = set()
+        # preallocate for the upper bound of scorable positions; dedup may use less
+        n_max = max(total_len - start_pos, 0)
+        seeds = np.empty(n_max, dtype=np.uint64)
+        scored_tokens = np.empty(n_max, dtype=np.int64)
+        n_valid = 0
+
+        # hash-mode seeds for every window come from one compiled parallel pass
+        all_seeds = None
+        if self.config.seeding == 'hash':
+            all_seeds = _hash_seeds_all(np.asarray(tokens_id, dtype=np.uint64), self.config.ngram,
+                                        np.uint64(self.config.seed), np.uint64(self.config.salt_key))
+
+        # uint64 rolling polynomial hash of the ngram window, so dedup inserts an
+        # int instead of building a fresh tuple per position
+        mask64 = (1 << 64) - 1
+        base = 1000003
+        base_pow = pow(base, self.config.ngram, 1 << 64)
+        rolling = 0
+        for tok in tokens_id[start_pos - self.config.ngram: start_pos]:
+            rolling = (rolling * base + tok) & mask64
 
         for cur_pos in range(start_pos, total_len):
-            ngram_tokens = tokens_id[cur_pos - self.config.ngram: cur_pos]
+            if cur_pos > start_pos:
+                # slide the window: append the newest token, drop the oldest
+                rolling = (rolling * base + tokens_id[cur_pos - 1]
+                           - base_pow * tokens_id[cur_pos - 1 - self.config.ngram]) & mask64
             if scoring_method == 'v1':
-                tup_for_unique = tuple(ngram_tokens)
-                if tup_for_unique in seen_ntuples:
+                if rolling in seen_ntuples:
                     continue
-                seen_ntuples.add(tup_for_unique)
+                seen_ntuples.add(rolling)
             elif scoring_method == 'v2':
-                tup_for_unique = tuple(ngram_tokens + [tokens_id[cur_pos]])
-                if tup_for_unique in seen_ntuples:
+                key = (rolling * base + tokens_id[cur_pos]) & mask64
+                if key in seen_ntuples:
                     continue
-                seen_ntuples.add(tup_for_unique)
-
-            rt = self.score_tok(ngram_tokens, tokens_id[cur_pos])
-            rt = rt[:payload_max + 1]
-            rts.append(rt)
+                seen_ntuples.add(key)
+
+            if all_seeds is not None:
+                seeds[n_valid] = all_seeds[cur_pos - start_pos]
+            else:
+                ngram_tokens = tokens_id[cur_pos - self.config.ngram: cur_pos]
+                seeds[n_valid] = self.get_seed_rng(torch.tensor(ngram_tokens))
+            scored_tokens[n_valid] = tokens_id[cur_pos]
+            n_valid += 1
+
+        if n_valid == 0:
+            return np.array([])
+
+        # fill one (n_positions, vocab_size) uniform matrix from the per-ngram seeds
+        u = torch.empty((n_valid, self.config.vocab_size), device=self.rng.device)
+        for i in range(n_valid):
+            seed = int(seeds[i])
+            cached = self._rs_cache.get(seed)
+            if cached is not None:
+                self._rs_cache.move_to_end(seed)
+                u[i] = cached
+            else:
+                self.rng.manual_seed(seed)
+                torch.rand(self.config.vocab_size, generator=self.rng, out=u[i])
+                self._rs_cache[seed] = u[i].clone()
+                if len(self._rs_cache) > self._rs_cache_capacity:
+                    self._rs_cache.popitem(last=False)
+
+        # rs.roll(-token_id)[:payload_max + 1] equals columns (token_id + payload) % vocab_size,
+        # so gather the scored entries first and log only those instead of the full matrix
+        token_ids = torch.from_numpy(scored_tokens[:n_valid]).to(u.device)
+        payloads = torch.arange(payload_max + 1, device=u.device)
+        cols = (token_ids.unsqueeze(1) + payloads.unsqueeze(0)) % self.config.vocab_size
+        # avoid log(0)
+        rts = u.gather(1, cols).clamp_min_(1e-4).log_().neg_()
 
-        return np.array([rt.cpu().numpy() for rt in rts])
+        return rts.cpu().numpy()
 
     def get_scores(self,score_lists: np.array) -> float:
         """calculate sum of PF score."""
         if len(score_lists) == 0:
             return 0
-        aggregated_score = sum(score_lists)
-        return aggregated_score
+        return score_lists.sum(axis=0)
 
 
 
@@ -218,27 +370,27 @@ class PF(BaseWatermark):
     def generate_watermarked_text(self, prompt: str, *args, **kwargs) -> str:
         """Generate watermarked text using the PF algorithm."""
 
-        prompt_tokens = self.config.generation_tokenizer.encode(prompt, add_special_tokens=False)
+        prompt_tokens = self.config.generation_tokenizer(prompt, add_special_tokens=False)['input_ids']
         min_prompt_size = len(prompt_tokens)
         total_len = min(self.config.max_seq_len, self.config.gen_kwargs["max_new_tokens"] + min_prompt_size)
 
         tokens = torch.full((total_len,), self.utils.pad_id).to(self.config.generation_model.device).long()
         tokens[: len(prompt_tokens)] = torch.tensor(prompt_tokens).long()
-        input_text_mask = tokens != self.utils.pad_id
 
         start_pos = min_prompt_size
         prev_pos = 0
-        for cur_pos in range(start_pos, total_len):
-            outputs = self.config.generation_model.forward(
-                tokens[prev_pos:cur_pos].unsqueeze(0), use_cache=True,
-                past_key_values=outputs.past_key_values if prev_pos > 0 else None
-            )
-            ngram_tokens = tokens[cur_pos - self.config.ngram:cur_pos]
-            temperature = self.config.gen_kwargs.get("temperature", 0.9)
-            top_p = self.config.gen_kwargs.get("top_p", 1.0)
-            next_toks = self.utils.sample_next(outputs.logits[:, -1, :], ngram_tokens, temperature, top_p)
-            tokens[cur_pos] = torch.where(input_text_mask[cur_pos], tokens[cur_pos], next_toks)
-            prev_pos = cur_pos
+        temperature = self.config.gen_kwargs.get("temperature", 0.9)
+        top_p = self.config.gen_kwargs.get("top_p", 1.0)
+        with torch.no_grad():
+            for cur_pos in range(start_pos, total_len):
+                outputs = self.config.generation_model.forward(
+                    tokens[prev_pos:cur_pos].unsqueeze(0), use_cache=True,
+                    past_key_values=outputs.past_key_values if prev_pos > 0 else None
+                )
+                ngram_tokens = tokens[cur_pos - self.config.ngram:cur_pos]
+                next_toks = self.utils.sample_next(outputs.logits[:, -1, :], ngram_tokens, temperature, top_p)
+                tokens[cur_pos] = next_toks
+                prev_pos = cur_pos
 
         tokens = tokens.tolist()
 